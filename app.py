@@ -7,58 +7,252 @@
 # --------------------------
 import streamlit as st          # Streamlit is used to build the web app
 import pyotp                   # pyotp helps us generate and verify one-time passwords (OTP)
-import qrcode                  # qrcode generates QR codes for Google Authenticator setup
+import segno                   # segno generates QR codes (as PNG) for Google Authenticator setup
 import io                      # io is used to handle in-memory image buffers
-import json                    # json is used to save/load user data persistently
+import orjson                  # orjson is a fast JSON library used to save/load user data persistently
 import os                      # os is used to check if data files exist
-from PIL import Image          # PIL (Pillow) is used to display and resize QR codes
+import pandas as pd            # pandas builds the admin's customer table
 import random                  # random helps simulate large transfer requests for admin demo
+import time                    # time is used to check which 30 sec OTP step we are in
+import sqlite3                 # sqlite3 stores account balances with atomic transfers
+import threading               # threading.RLock serializes changes to shared user data and the database
+import hmac                    # hmac.compare_digest compares secrets in constant time
+import hashlib                 # hashlib pre-hashes passwords that are too long for bcrypt
+import base64                  # base64 turns that pre-hash into bcrypt-safe bytes
+import re                      # re checks whether a stored password is already a bcrypt hash
+import bcrypt                  # bcrypt hashes passwords so they are never stored in plain text
 
 # --------------------------
 # 📁 Persistent Storage Setup
 # --------------------------
-DATA_FILE = "users.json"  # File where user accounts and balances are stored
+DATA_FILE = "users.json"  # File where user accounts (and starting balances) are stored
+DB_FILE = "users.db"      # SQLite database holding the live account balances
 
-# Function to save users back to file
+# Function to save users back to file.
+# We write to a temporary file first and then swap it in with os.replace, which is
+# atomic: a crash mid-write can never leave a half-written users.json behind.
 def save_users(users):
-    with open(DATA_FILE, "w") as f:          # Open file in write mode
-        json.dump(users, f, indent=4)        # Dump users as pretty-printed JSON
+    tmp = DATA_FILE + ".tmp"
+    with open(tmp, "wb") as f:           # Open temporary file in binary write mode
+        f.write(orjson.dumps(users))     # Dump users as compact JSON
+        f.flush()
+        os.fsync(f.fileno())             # Make sure the data is on disk before the swap
+    os.replace(tmp, DATA_FILE)           # Atomically replace the old file
+
+# bcrypt only accepts up to 72 bytes of password; a bcrypt hash looks like
+# "$2b$10$" followed by 53 characters of salt + hash ($2a$ and $2y$ also occur)
+BCRYPT_MAX_BYTES = 72
+BCRYPT_HASH_RE = re.compile(r"\$2[aby]\$\d{2}\$[./A-Za-z0-9]{53}")
+
+# Function to turn a password into the bytes given to bcrypt.
+# Passwords longer than bcrypt's limit are first reduced to a SHA-256 digest
+# (base64-encoded, 44 bytes), so long passwords still work and are not cut off.
+def _bcrypt_input(password):
+    data = password.encode()
+    if len(data) > BCRYPT_MAX_BYTES:
+        data = base64.b64encode(hashlib.sha256(data).digest())
+    return data
+
+# Function to hash a plain-text password with bcrypt
+def hash_password(password):
+    return bcrypt.hashpw(_bcrypt_input(password), bcrypt.gensalt(rounds=10)).decode()
+
+# Function to replace any plain-text passwords with bcrypt hashes; returns True if anything changed
+def upgrade_passwords(users):
+    changed = False
+    for u in users:
+        if not BCRYPT_HASH_RE.fullmatch(users[u]["password"]):  # Not a bcrypt hash yet
+            users[u]["password"] = hash_password(users[u]["password"])
+            changed = True
+    return changed
+
+# Function to check a typed password against the stored bcrypt hash
+def check_password(password, password_hash):
+    try:
+        return bcrypt.checkpw(_bcrypt_input(password), password_hash.encode())
+    except ValueError:                   # Stored value isn't a valid bcrypt hash
+        return False
+
+# Return the shared SQLite connection that stores account balances.
+# WAL mode lets readers keep going while a transfer is being written.
+@st.cache_resource(show_spinner=False)
+def get_conn():
+    conn = sqlite3.connect(DB_FILE, check_same_thread=False, isolation_level=None)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    conn.execute("CREATE TABLE IF NOT EXISTS accounts (user TEXT PRIMARY KEY, balance INTEGER NOT NULL)")
+    return conn
+
+# The single shared user store: one lock plus the users dict loaded from users.json.
+# Cached with st.cache_resource, so every rerun and every browser session gets the same
+# object, and all changes (to users.json or the database) go through the same lock.
+@st.cache_resource(show_spinner=False)
+def user_store():
+    # "version" counts balance changes, so cached views of balances know when to refresh
+    return {"lock": threading.RLock(), "data": {}, "mtime": None, "version": 0}
+
+# Function to copy balances from users.json into the database.
+# With reset=False only accounts not in the database yet are added.
+def seed_balances(users, reset=False):
+    verb = "INSERT OR REPLACE" if reset else "INSERT OR IGNORE"
+    rows = [(u, d["balance"]) for u, d in users.items() if "balance" in d]
+    store = user_store()
+    with store["lock"]:
+        get_conn().executemany(f"{verb} INTO accounts (user, balance) VALUES (?, ?)", rows)
+        store["version"] += 1
+
+# Function to read one user's current balance.
+# Reads take the lock too: on the shared connection, a read in the middle of a
+# transfer would otherwise see a debit that may still be rolled back.
+def get_balance(user):
+    with user_store()["lock"]:
+        row = get_conn().execute("SELECT balance FROM accounts WHERE user = ?", (user,)).fetchone()
+    return row[0] if row else 0
+
+# Function to read all balances as a {user: balance} dictionary
+def get_balances():
+    with user_store()["lock"]:
+        return dict(get_conn().execute("SELECT user, balance FROM accounts"))
+
+# Function to move money between two accounts in one atomic transaction.
+# The "balance >= ?" condition makes the funds check and the debit a single step,
+# so two simultaneous transfers can never overdraw an account. If either account is
+# missing the whole transaction is rolled back. Returns True on success.
+def transfer(src, dst, amount):
+    if dst is None or src == dst:             # No recipient, or sending money to yourself
+        return False
+    conn = get_conn()
+    store = user_store()
+    with store["lock"]:
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            cur = conn.execute(
+                "UPDATE accounts SET balance = balance - ? WHERE user = ? AND balance >= ?", (amount, src, amount)
+            )
+            if cur.rowcount == 0:             # Not enough funds (or unknown sender)
+                conn.execute("ROLLBACK")
+                return False
+            cur = conn.execute("UPDATE accounts SET balance = balance + ? WHERE user = ?", (amount, dst))
+            if cur.rowcount == 0:             # Unknown recipient: undo the debit
+                conn.execute("ROLLBACK")
+                return False
+            conn.execute("COMMIT")
+            store["version"] += 1
+            return True
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
 
 # Function to load users from file, or create defaults if file is missing/corrupted
-def load_users():
+def _read_users_file():
     if not os.path.exists(DATA_FILE) or os.path.getsize(DATA_FILE) == 0:  # If no file or file empty
         # Default users created the very first time
         users = {
-            "customer1": {"password": "secure123", "role": "Customer", "balance": 1500, "secret": pyotp.random_base32()},
-            "customer2": {"password": "wallet321", "role": "Customer", "balance": 3200, "secret": pyotp.random_base32()},
-            "admin1": {"password": "adminpass", "role": "Admin", "secret": pyotp.random_base32()},
+            "customer1": {"password": "secure123", "role": "Customer", "balance": 1500, "secret": None},
+            "customer2": {"password": "wallet321", "role": "Customer", "balance": 3200, "secret": None},
+            "admin1": {"password": "adminpass", "role": "Admin", "secret": None},
         }
+        upgrade_passwords(users)  # Store only password hashes
         save_users(users)  # Save to JSON file
+        seed_balances(users, reset=True)  # Fresh accounts start from their default balances
         return users
     else:
         try:
-            with open(DATA_FILE, "r") as f:  # Open file for reading
-                users = json.load(f)         # Load JSON content into dictionary
-            # Ensure each user has a secret for OTP
-            changed = False
+            with open(DATA_FILE, "rb") as f:   # Open file for reading
+                users = orjson.loads(f.read()) # Load JSON content into dictionary
+            # OTP secrets are created lazily (see ensure_secret), so a missing one is just None
             for u in users:
-                if "secret" not in users[u]:
-                    users[u]["secret"] = pyotp.random_base32()
-                    changed = True
-            if changed:                      # If we added new secrets, save back
+                users[u].setdefault("secret", None)
+            # Upgrade old plain-text passwords to bcrypt hashes, and save them back
+            if upgrade_passwords(users):
                 save_users(users)
+            seed_balances(users)             # Add any new accounts to the balance database
             return users
-        except json.JSONDecodeError:         # Handle corrupted JSON file
+        except orjson.JSONDecodeError:       # Handle corrupted JSON file
             users = {
-                "customer1": {"password": "secure123", "role": "Customer", "balance": 1500, "secret": pyotp.random_base32()},
-                "customer2": {"password": "wallet321", "role": "Customer", "balance": 3200, "secret": pyotp.random_base32()},
-                "admin1": {"password": "adminpass", "role": "Admin", "secret": pyotp.random_base32()},
+                "customer1": {"password": "secure123", "role": "Customer", "balance": 1500, "secret": None},
+                "customer2": {"password": "wallet321", "role": "Customer", "balance": 3200, "secret": None},
+                "admin1": {"password": "adminpass", "role": "Admin", "secret": None},
             }
+            upgrade_passwords(users)
             save_users(users)
+            seed_balances(users)             # Keep live balances; only add missing accounts
             return users
 
-# Load all users into memory
-USERS = load_users()
+# Return the shared users dict, re-reading users.json only when its modification
+# time (mtime) has changed since we last loaded it
+def get_users():
+    store = user_store()
+    with store["lock"]:
+        mtime = os.path.getmtime(DATA_FILE) if os.path.exists(DATA_FILE) else 0.0
+        if mtime != store["mtime"]:
+            store["data"] = _read_users_file()
+            store["mtime"] = os.path.getmtime(DATA_FILE)  # Reading may have saved the file again
+        return store["data"]
+
+# Load all users into memory (same shared object on every rerun; balances
+# themselves are always read from the database)
+USERS = get_users()
+
+# Return a user's OTP secret, generating and saving it the first time it is needed
+# (changes the shared store directly, so no session can save over it with an older copy)
+def ensure_secret(username):
+    store = user_store()
+    with store["lock"]:
+        users = store["data"]
+        if users[username]["secret"] is None:
+            users[username]["secret"] = pyotp.random_base32()
+            save_users(users)
+            store["mtime"] = os.path.getmtime(DATA_FILE)  # Our own save: no reload needed
+        return users[username]["secret"]
+
+# Return a TOTP generator for a secret, built once per secret and reused on every rerun
+@st.cache_resource(show_spinner=False)
+def get_totp(secret: str) -> pyotp.TOTP:
+    return pyotp.TOTP(secret)
+
+# Check an OTP against the previous, current and next 30 sec step (allow ±30 sec drift),
+# comparing in constant time so response timing doesn't leak how many digits matched.
+# Memoized per (secret, otp, 30 sec step) with st.cache_data, which survives reruns
+# (Streamlit re-runs this script as a fresh module, so functools.lru_cache would
+# start empty every time). The step counter changes every 30 sec, so stale results
+# are never reused once the OTP window has moved on, and ttl drops old entries.
+@st.cache_data(ttl=30, max_entries=256, show_spinner=False)
+def _verify_cached(secret, otp, counter, window=1):
+    if not (otp.isascii() and otp.isdigit()):  # OTPs are plain ASCII digits only
+        return False
+    totp = get_totp(secret)
+    for_time = counter * totp.interval
+    return any(hmac.compare_digest(otp.encode(), totp.at(for_time, offset).encode()) for offset in range(-window, window + 1))
+
+# Build the Google Authenticator QR code for a user and return it as PNG bytes.
+# Cached with st.cache_data so the expensive QR drawing only runs once per user.
+@st.cache_data(max_entries=128, show_spinner=False)
+def render_qr_png(username: str, secret: str) -> bytes:
+    # Generate provisioning URI for Google Authenticator
+    uri = get_totp(secret).provisioning_uri(
+        name=f"{username}@fintechdemo.com", issuer_name="FinTech Demo App"
+    )
+    # Draw the QR code directly as PNG at roughly the display size (no PIL needed)
+    buf = io.BytesIO()                            # Create in-memory buffer
+    segno.make(uri, error="l").save(buf, kind="png", scale=7, border=2)  # Save QR image to buffer
+    return buf.getvalue()                         # Return the raw PNG bytes
+
+# Sorted usernames of all customers. Roles only change when users.json changes,
+# so the user count + file mtime are enough to know when to rebuild the list.
+# Old keys are never needed again, so only the latest few entries are kept.
+@st.cache_data(max_entries=4, show_spinner=False)
+def _customer_usernames(user_count: int, mtime: float) -> tuple[str, ...]:
+    return tuple(sorted(u for u, d in USERS.items() if d["role"] == "Customer"))
+
+# Table of all customers and their balances for the admin dashboard.
+# Rebuilt only when users.json (mtime) or any balance (version) has changed;
+# only the latest few tables are kept, since every transfer creates a new key.
+@st.cache_data(max_entries=4, show_spinner=False)
+def _customer_df(mtime: float, version: int) -> pd.DataFrame:
+    balances = get_balances()
+    rows = [(u, balances.get(u, 0)) for u, d in USERS.items() if d["role"] == "Customer"]
+    return pd.DataFrame(rows, columns=["user", "balance"])
 
 # --------------------------
 # 🎨 Streamlit Page Configuration
@@ -73,7 +267,7 @@ st.markdown("""                                              # Short description
 This is a **mini FinTech system** with:
 - ✅ 2FA login (Google Authenticator, per user)
 - ✅ RBAC (Role-Based Access Control)
-- ✅ Persistent storage (balances & secrets saved in `users.json`)
+- ✅ Persistent storage (accounts & secrets in `users.json`, balances in `users.db`)
 """)
 
 # --------------------------
@@ -81,40 +275,55 @@ This is a **mini FinTech system** with:
 # --------------------------
 st.subheader("🔑 Step 1: Login")  # Login section header
 
-# Input fields for login
-username = st.text_input("Username")                 # Username field
-password = st.text_input("Password", type="password")# Password field (hidden)
-otp_input = st.text_input("Enter OTP (6 digits)", max_chars=6)  # OTP input
+# Input fields for login, grouped in a form: typing doesn't rerun the app,
+# it only reruns once one of the form's buttons is clicked
+with st.form("login_form", clear_on_submit=False):
+    username = st.text_input("Username")                 # Username field
+    password = st.text_input("Password", type="password")# Password field (hidden)
+    otp_input = st.text_input("Enter OTP (6 digits)", max_chars=6)  # OTP input
+    # Login must be the first submit button: pressing Enter in a field clicks the first one
+    submitted = st.form_submit_button("Login")           # Login button
+    show_qr = st.form_submit_button("Show 2FA QR")      # Show the Google Authenticator QR for this user
 
 # Initialize session state for login tracking
 if "logged_in" not in st.session_state:
     st.session_state.logged_in = False
     st.session_state.user = None
 
-# If user typed a username that exists, show QR code for their OTP secret
-if username and username in USERS:
-    user_secret = USERS[username]["secret"]   # Fetch secret for this user
-    # Generate provisioning URI for Google Authenticator
-    uri = pyotp.TOTP(user_secret).provisioning_uri(
-        name=f"{username}@fintechdemo.com", issuer_name="FinTech Demo App"
-    )
-    qr = qrcode.make(uri)                     # Generate QR code
-    buf = io.BytesIO()                        # Create in-memory buffer
-    qr.save(buf, format="PNG")                # Save QR image to buffer
-    buf.seek(0)                               # Reset buffer pointer
-    qr_img = Image.open(buf).resize((250, 250))  # Open and resize QR image
-    st.image(qr_img, caption=f"📱 Scan this QR in Google Authenticator for {username}", use_container_width=False)
+# If user asked for the QR of a username that exists, show QR code for their OTP secret.
+# The fragment has no widgets of its own, so it runs as part of every full rerun.
+# The last rendered (username, secret) pair and its PNG are kept in session state,
+# so an unchanged QR is reused directly without even a cache lookup.
+@st.fragment
+def qr_fragment(username):
+    st.session_state.setdefault("qr_key", None)
+    if username and username in USERS:
+        user_secret = ensure_secret(username)     # Fetch (or create) secret for this user
+        if (username, user_secret) != st.session_state.qr_key:
+            st.session_state.qr_png = render_qr_png(username, user_secret)  # Cached QR code PNG
+            st.session_state.qr_key = (username, user_secret)
+        # Streamlit removes elements that aren't drawn again on a rerun, so the image
+        # is always emitted; the browser reuses the same media URL for identical bytes.
+        st.image(st.session_state.qr_png, caption=f"📱 Scan this QR in Google Authenticator for {username}", width=250)
+
+# Remember which user's QR was requested, so it stays visible until they log in
+if show_qr:
+    st.session_state.qr_user = username
+qr_fragment(st.session_state.get("qr_user"))
 
 # Login button logic
-if st.button("Login"):
-    if username in USERS and password == USERS[username]["password"]:  # Check username/password
+if submitted:
+    if username in USERS and check_password(password, USERS[username]["password"]):  # Check username/password
         role = USERS[username]["role"]                                # Fetch role
-        user_totp = pyotp.TOTP(USERS[username]["secret"])             # Get user-specific TOTP generator
+        counter = int(time.time()) // 30                              # Current 30 sec OTP step
 
-        if user_totp.verify(otp_input, valid_window=1):  # Verify OTP, allow ±30 sec drift
+        if _verify_cached(ensure_secret(username), otp_input, counter):  # Verify OTP, allow ±30 sec drift
             st.session_state.logged_in = True
             st.session_state.user = username
-            st.session_state.role = role
+            # Cache the RBAC decisions for this session, so later reruns don't look them up again
+            st.session_state.perms = {"transfer": role == "Customer", "approve": role == "Admin"}
+            st.session_state.pop("balance_version", None)  # Fresh balance for the newly logged-in user
+            st.session_state.pop("qr_user", None)  # QR no longer needed once logged in
             st.success(f"🎉 Login successful! Welcome {username} ({role}).")  # Success message
             st.balloons()  # Show balloons animation
         else:
@@ -125,55 +334,61 @@ if st.button("Login"):
 # --------------------------
 # 👤 Customer Dashboard
 # --------------------------
-if st.session_state.logged_in and st.session_state.role == "Customer":
+if st.session_state.get("perms", {}).get("transfer"):
     user = st.session_state.user
     st.header("👤 Customer Dashboard")             # Section header
     st.write(f"Welcome **{user}**")                # Show username
 
-    balance = USERS[user]["balance"]               # Get balance
-    st.metric("💰 Account Balance", f"${balance}") # Show balance metric
+    # Keep the balance in the session, re-reading it only when any balance has changed
+    # (the store's version goes up on every transfer, including ones sent to this user)
+    version = user_store()["version"]
+    if st.session_state.get("balance_version") != version:
+        st.session_state.balance = get_balance(user)
+        st.session_state.balance_version = version
+    st.metric("💰 Account Balance", f"${st.session_state.balance}") # Show balance metric
 
     st.subheader("💸 Make a Transfer")             # Transfer section
     # Select recipient (only other customers)
-    recipient = st.selectbox("Select recipient", [u for u in USERS if USERS[u]["role"] == "Customer" and u != user])
+    customers = _customer_usernames(len(USERS), os.path.getmtime(DATA_FILE))
+    recipient = st.selectbox("Select recipient", [u for u in customers if u != user])
     amount = st.number_input("Enter amount", min_value=1, max_value=10000, step=1)  # Transfer amount
 
     # Transfer button
     if st.button("Transfer Money"):
-        if amount <= USERS[user]["balance"]:       # Check balance
-            USERS[user]["balance"] -= amount       # Deduct from sender
-            USERS[recipient]["balance"] += amount  # Add to recipient
-            save_users(USERS)                      # Save updated balances
-            st.success(f"✅ Transfer of ${amount} to {recipient} successful!") # Success message
+        if transfer(user, recipient, amount):      # Check balance, deduct and add in one transaction
+            # "\$" so Streamlit's markdown doesn't read text between two $ signs as LaTeX math
+            st.success(f"✅ Transfer of \\${amount} to {recipient} successful!") # Success message
         else:
-            st.error("❌ Insufficient funds.")      # Error if not enough balance
+            st.error("❌ Transfer failed: insufficient funds or invalid recipient.")  # Nothing was moved
 
 # --------------------------
 # 👨‍💼 Admin Dashboard
 # --------------------------
-elif st.session_state.logged_in and st.session_state.role == "Admin":
+elif st.session_state.get("perms", {}).get("approve"):
     st.header("👨‍💼 Admin Dashboard")               # Section header
     st.write(f"Welcome **{st.session_state.user}**")
 
     st.subheader("📋 View All Customer Accounts")  # Show all balances
-    for u, data in USERS.items():
-        if data["role"] == "Customer":
-            st.write(f"**{u}** → Balance: ${data['balance']}")
+    # One cached table for all customers (instead of one element per customer)
+    customer_df = _customer_df(os.path.getmtime(DATA_FILE), user_store()["version"])
+    st.dataframe(customer_df, width="stretch", hide_index=True)
 
     st.subheader("✅ Approve Large Transfers")      # Simulated approval section
-    fake_request = {"from": "customer1", "to": "customer2", "amount": random.randint(5000, 10000)}
-    st.write(f"Pending Request: {fake_request['from']} → {fake_request['to']} | Amount: ${fake_request['amount']}")
+    # Generate the simulated request once per session, so it stays the same across reruns
+    if "pending_req" not in st.session_state:
+        st.session_state.pending_req = {"from": "customer1", "to": "customer2", "amount": random.randint(5000, 10000)}
+    fake_request = st.session_state.pending_req
+    st.write(f"Pending Request: {fake_request['from']} → {fake_request['to']} | Amount: \\${fake_request['amount']}")
 
     if st.button("Approve Transfer"):
-        if USERS[fake_request["from"]]["balance"] >= fake_request["amount"]:
-            USERS[fake_request["from"]]["balance"] -= fake_request["amount"]
-            USERS[fake_request["to"]]["balance"] += fake_request["amount"]
-            save_users(USERS)
+        if transfer(fake_request["from"], fake_request["to"], fake_request["amount"]):
+            del st.session_state.pending_req       # Request handled; a new one is generated next time
             st.success("✅ Transfer approved and processed!")
         else:
-            st.error("❌ Insufficient funds in sender account.")
+            st.error("❌ Transfer failed: insufficient funds in sender account or invalid recipient.")
 
     if st.button("Reject Transfer"):
+        del st.session_state.pending_req
         st.warning("❌ Transfer request rejected.")
 
 # --------------------------
@@ -181,8 +396,10 @@ elif st.session_state.logged_in and st.session_state.role == "Admin":
 # --------------------------
 with st.expander("ℹ️ Teaching Notes"):   # Collapsible teaching notes
     st.markdown("""
-    - **Persistence**: All account data (including OTP secrets) is saved in `users.json`.
+    - **Persistence**: Account data (including OTP secrets) is saved in `users.json`;
+      live balances are kept in the SQLite database `users.db`, where each transfer is one atomic transaction.
     - **2FA**: Each user has a unique Google Authenticator secret.
+    - **Password hashing**: Passwords are stored as bcrypt hashes, never in plain text.
     - **RBAC**: Customers can transfer/view balances; Admins can manage system.
     - **Security Principle**: Authentication (who you are) + Authorization (what you can do).
     """)